@@ -1,11 +1,20 @@
 from ola.ClientWrapper import ClientWrapper
 from vlc import Instance
+import logging
+import pyudev
 import vlc
 import subprocess
 import signal
 import time
 import os
 
+log = logging.getLogger("mediaserver")
+
+#Prüft ohne vollständiges Auflisten, ob ein Verzeichnis leer ist
+def _is_empty(path):
+  with os.scandir(path) as it:
+    return next(it, None) is None
+
 class Tmp:
   #Konstruktor
   def __init__ (self):
@@ -13,6 +22,7 @@ class Tmp:
     self.current = 0
     self.address = 1
     self.usb = None
+    self.udev = pyudev.Context()
     self.findStick()
 
     #Start VLC
@@ -20,6 +30,27 @@ class Tmp:
     self.i = Instance('--codec avcodec,none')
     #self.i = Instance("--codec avcodec,none --sub-filter logo")
     self.media_player = self.i.media_player_new()
+    self.media_player.video_set_adjust_int(vlc.VideoAdjustOption.Enable, 1)
+
+    #Bildeinstellungen je Kanal ab address+1, nur bei geänderten Werten aufgerufen
+    self._hue_lut = tuple(((v+128)%256)*1.411-180 for v in range(256))
+    self._bri_lut = tuple(v/128 for v in range(256))
+    self._con_lut = self._bri_lut
+    self._sat_lut = tuple(v/85 for v in range(256))
+    self._gam_lut = tuple(v/25 for v in range(256))
+    self._scale_lut = self._gam_lut
+    adj = self.media_player.video_set_adjust_float
+    scale = self.media_player.video_set_scale
+    hue, bri, con, sat, gam, sca = self._hue_lut, self._bri_lut, self._con_lut, self._sat_lut, self._gam_lut, self._scale_lut
+    self._adjust = (
+      lambda v: adj(vlc.VideoAdjustOption.Hue, hue[v]),
+      lambda v: adj(vlc.VideoAdjustOption.Brightness, bri[v]),
+      lambda v: adj(vlc.VideoAdjustOption.Contrast, con[v]),
+      lambda v: adj(vlc.VideoAdjustOption.Saturation, sat[v]),
+      lambda v: adj(vlc.VideoAdjustOption.Gamma, gam[v]),
+      lambda v: scale(sca[v]),
+    )
+    self._prev_bytes = None
 
     #Logo Overlay (for Dimmer)
     #self.media_player.video_set_logo_string(vlc.VideoLogoOption.logo_file, "/home/pi/python/black.png")
@@ -32,45 +63,62 @@ class Tmp:
     #self.media_player.video_set_logo_int(vlc.VideoLogoOption.logo_enable, 1)
     
    
-  #USB-Stick Such-Schleife
+  #USB-Stick Such-Schleife, wartet auf udev-Ereignisse, spätestens alle 2 s wird erneut geprüft
   def findStick(self,):
-    while len(os.listdir("/media/pi/")) == 0:
-      time.sleep(2)
-      print('[{3}:{4}:{5}]\tError no USB Device Found'.format(*time.localtime(time.time())))
+    monitor = pyudev.Monitor.from_netlink(self.udev)
+    monitor.filter_by('block')
+    monitor.start()
+    while _is_empty("/media/pi/"):
+      log.warning("Error no USB Device Found")
+      device = monitor.poll(timeout=2)
+      if (device is not None and device.action == 'add' and device.get('ID_FS_USAGE') == 'filesystem'):
+        #Auf Automount warten
+        for i in range(20):
+          if not _is_empty("/media/pi/"):
+            break
+          time.sleep(0.5)
 
     self.usb = os.listdir("/media/pi/")[0]
+    self._mrls = tuple("/media/pi/" + self.usb + "/0000" + str(i) + ".mp4" for i in range(256))
 
 
   #Eingehendes DMX Paket
   def NewData(self, data):
     #Abfrage auf Stick
-    if len(os.listdir("/media/pi/")) == 0:
+    if _is_empty("/media/pi/"):
       self.findStick()
 
+    a = self.address
+    mp = self.media_player
+
     #Auswahl von Videoaktion
-    self.current = data[self.address-1]
-    if (self.current != self.last): #Bei Änderung von DMX Wert
-      if (self.current > 0):
-        print("Stop Previous")
-        print("Play " + str(self.current))
-        self.media_player.set_mrl("/media/pi/PAULH32A/0000" + str(self.current) + ".mp4")
-        self.media_player.play()
+    current = data[a-1]
+    self.current = current
+    if (current != self.last): #Bei Änderung von DMX Wert
+      if (current > 0):
+        log.debug("Play %d", current)
+        mp.set_mrl(self._mrls[current])
+        mp.play()
       else:
-        print("Stop Previous")
-        self.media_player.stop()
-    self.last = self.current
-    self.media_player.video_set_adjust_int(vlc.VideoAdjustOption.Enable, 1)
-    self.media_player.video_set_adjust_float(vlc.VideoAdjustOption.Hue, ((data[self.address]+128)%256)*1.411-180)
-    self.media_player.video_set_adjust_float(vlc.VideoAdjustOption.Brightness, data[self.address+1]/128)
-    self.media_player.video_set_adjust_float(vlc.VideoAdjustOption.Contrast, data[self.address+2]/128)
-    self.media_player.video_set_adjust_float(vlc.VideoAdjustOption.Saturation, data[self.address+3]/85)
-    self.media_player.video_set_adjust_float(vlc.VideoAdjustOption.Gamma, data[self.address+4]/25)
-    self.media_player.video_set_scale(data[self.address+5]/25)
+        log.debug("Stop Previous")
+        mp.stop()
+    self.last = current
+
+    #Bildeinstellungen nur für geänderte Kanäle setzen
+    cur = bytes(data[a:a+6])
+    prev = self._prev_bytes
+    if (cur != prev):
+      adjust = self._adjust
+      for i, v in enumerate(cur):
+        if (prev is None or v != prev[i]):
+          adjust[i](v)
+      self._prev_bytes = cur
     #self.media_player.video_set_logo_int(vlc.VideoLogoOption.logo_opacity, data[self.address+6])
     
 
 #Programmaufruf
 def main():
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
   tmp = Tmp()
 
   universe = 1
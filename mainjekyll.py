@@ -6,12 +6,39 @@
 
 from vlc import Instance
 import configparser
-import traceback
+import logging
+import threading
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 import vlc
+import socket
 import sacn
 import time
 import os
 
+log = logging.getLogger("mediaserver")
+
+################
+# VLC-INSTANCE #
+################
+#Shared by all players of this process, so plugin discovery runs only once
+_VLC_INSTANCE = vlc.Instance("--no-video-title-show", "--quiet", "--file-caching=50", "--network-caching=50")
+
+################
+# CONFIG       #
+################
+#load_config(String)
+#Returns dict of dmx values from configfile at path
+def load_config(path):
+  config = configparser.RawConfigParser()
+  config.read(path)
+  section = config["DMX-Konfiguration"]
+  return {
+    "address": int(section["Adresse"]),
+    "universe": int(section["Universum"]),
+    "rcvbuf": int(section.get("Empfangspuffer", 4*1024*1024)),
+  }
+
 ################
 # SERVER-CLASS #
 ################
@@ -19,106 +46,226 @@ class Server:
   def __init__ (self):
     self.mediapath = "/home/pi/media/"
     self.configpath = "/home/pi/config.txt"
+    self._dir_cache = {}
+    self._index_lock = threading.Lock()
+    self.index = []
+    self.hasMedia = os.path.isdir(self.mediapath)
+    if (self.hasMedia):
+      self.buildIndex()
+    else:
+      log.error("Media folder %s not found, no media will be played until it exists", self.mediapath)
     self.dmx = DMX()
     self.vlc = VLC()
+    self.rcvbuf = 4*1024*1024
     self.loadConfig(self.configpath)
     self.channellist = Channellist(self.dmx.address)
     self.receiver = sacn.sACNreceiver()
+    self._work_ev = threading.Event()
+    self._latest = None
+    self.debounce = 0.08
 
   #start()
   #Starts Mediaserver and initializes Callback-Method for incoming DMX-Frames
   def start(self):
-    #DMX Packet Callback
+    self.worker = threading.Thread(target=self._worker, name="DMX worker", daemon=True)
+    self.worker.start()
+    #DMX Packet Callback, only hands the frame over to the worker
     @self.receiver.listen_on('universe', universe=self.dmx.universe)
     def callback(packet):
-      self.channellist.update(packet)
-      if (self.channellist.isNew(0) | self.channellist.isNew(1)):
-        if (self.channellist.get(0) > 0):
-          playpath = self.getPlaypath(self.mediapath, self.channellist)
-          if (playpath != ""):
-            self.vlc.setMedia(playpath)
-            self.vlc.setLoop(self.channellist.get(2) > 127)
-            self.vlc.play()
-          else:
-            self.vlc.stop()
-        else:
-          self.vlc.stop()
+      self._latest = packet.dmxData
+      self._work_ev.set()
     self.receiver.start()
+    self.setReceiveBuffer(self.rcvbuf)
+    self.setRealtimePriority(20)
     self.receiver.join_multicast(self.dmx.universe)
+    self.watchMedia()
+
+  #_worker()
+  #Handles the latest received DMX-Frame, frames arriving in the meantime get coalesced
+  #After a file or folder change the selection is applied once no further change arrived for debounce seconds, so only the last selection of a fast fade gets played
+  def _worker(self):
+    while True:
+      self._work_ev.wait()
+      self._work_ev.clear()
+      if (not self.handleFrame(self._latest)):
+        continue
+      deadline = time.monotonic() + self.debounce
+      while self._work_ev.wait(max(deadline - time.monotonic(), 0)):
+        self._work_ev.clear()
+        if (self.handleFrame(self._latest)):
+          deadline = time.monotonic() + self.debounce
+      self.applySelection(self.channellist.get(0), self.channellist.get(1), self.channellist.get(2) > 127)
+
+  #handleFrame(Tuple)
+  #Updates channels with DMX-Data, returns True if file or folder changed
+  def handleFrame(self, dmxData):
+    self.channellist.update(dmxData)
+    return self.channellist.anyNew(FILE_MASK)
+
+  #applySelection(Int, Int, Boolean)
+  #Starts or stops media for selected file and folder
+  def applySelection(self, file, folder, loop):
+    if (not self.hasMedia):
+      self.checkMediapath()
+    if (file > 0):
+      playpath = self.getPlaypath(folder, file)
+      if (playpath != ""):
+        self.vlc.setMedia(playpath)
+        self.vlc.setLoop(loop)
+        self.vlc.play()
+      else:
+        self.vlc.stop()
+    else:
+      self.vlc.stop()
+
+  #checkMediapath()
+  #Builds the media index and starts watching mediapath once it exists, if it was missing at startup
+  def checkMediapath(self):
+    if (os.path.isdir(self.mediapath)):
+      log.info("Media folder %s found", self.mediapath)
+      self.hasMedia = True
+      self.watchMedia()
+
+  #setReceiveBuffer(Int)
+  #Raises kernel receive buffer of the sACN socket, so bursts of DMX-Frames don't get dropped
+  def setReceiveBuffer(self, size):
+    try:
+      if hasattr(self.receiver, "sock"):
+        sock = self.receiver.sock
+      else:
+        sock = self.receiver._handler.socket._socket
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+      log.info("Set receive buffer to %d bytes", sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+    except Exception as e:
+      log.warning("Couldn't set receive buffer: %s", e)
+
+  #setRealtimePriority(Int)
+  #Runs the sACN receiver thread with SCHED_FIFO, so DMX-Frames get drained without scheduler jitter
+  def setRealtimePriority(self, priority):
+    try:
+      thread = self.receiver._thread if hasattr(self.receiver, "sock") else self.receiver._handler.socket._thread
+      os.sched_setscheduler(thread.native_id, os.SCHED_FIFO, os.sched_param(priority))
+      log.info("Set receiver thread to SCHED_FIFO priority %d", priority)
+    except Exception as e:
+      log.warning("Couldn't set realtime priority: %s", e)
+
+  #watchMedia()
+  #Starts watchdog-observer on mediapath which rebuilds the media index when files get added, removed or moved
+  #Does nothing while mediapath is missing, checkMediapath() starts it later
+  def watchMedia(self):
+    if (not self.hasMedia):
+      return
+    server = self
+    class Handler(FileSystemEventHandler):
+      def on_created(self, event):
+        server.buildIndex()
+      def on_deleted(self, event):
+        server.buildIndex()
+      def on_moved(self, event):
+        server.buildIndex()
+    self.observer = Observer()
+    self.observer.daemon = True
+    self.observer.schedule(Handler(), self.mediapath, recursive=True)
+    self.observer.start()
+    self.buildIndex()
 
   #loadConfig(String)
   #Loads configfile from path and sets dmx values
   def loadConfig(self, configpath):
     try:
-      config = configparser.ConfigParser()
-      config.read(configpath)
-      self.dmx.address = config.getint("DMX-Konfiguration", "Adresse")
-      self.dmx.universe = config.getint("DMX-Konfiguration", "Universum")
-      print("Loaded adress", self.dmx.toString(), "from configfile")
+      config = load_config(configpath)
+      self.dmx.address = config["address"]
+      self.dmx.universe = config["universe"]
+      self.rcvbuf = config["rcvbuf"]
+      log.info("Loaded adress %s from configfile", self.dmx.toString())
       return
     except Exception as e:
-      print(traceback.format_exc())
-      print("Couldn't find config.txt, loaded adress", self.dmx.toString())
+      log.exception("Couldn't find config.txt, loaded adress %s", self.dmx.toString())
       return
 
-  #getPlaypath(String, Channellist)
-  #Calculates path of media file based on base-path and DMX-values
-  def getPlaypath(self, mediapath, channellist):
-    folderlist = sorted(os.listdir(mediapath))
-    if (len(folderlist)-1 >= self.channellist.get(1)):
-      folder = folderlist[self.channellist.get(1)]
-      filelist = sorted(os.listdir(mediapath + "/" + folder))
-      if (len(filelist) >= self.channellist.get(0)):
-        file = filelist[self.channellist.get(0)-1]
-        playpath = (mediapath + folder + "/" + file)
-        return playpath
+  #getPlaypath(Int, Int)
+  #Returns path of media file from index based on DMX-values of folder and file
+  def getPlaypath(self, folder, file):
+    index = self.index
+    if (len(index)-1 >= folder):
+      filelist = index[folder][1]
+      if (len(filelist) >= file):
+        return filelist[file-1]
     return ""
 
-#################
-# CHANNEL-CLASS #
-#################
-class Channel:
-  def __init__ (self, address):
-    self.current = -1
-    self.new = True
-    self.address = address
-
-  #update()
-  #Updates value of channel with packet and sets new flag
-  def update(self, packet):
-    value = packet.dmxData[self.address - 1]
-    if (self.current != value):
-      self.current = value
-      self.new = True
-    else:
-      self.new = False
-    return
+  #buildIndex()
+  #Builds list of (folder, filepaths) from sorted subfolders of mediapath, only changed directories get re-read
+  #Keeps the previous index if mediapath can't be read
+  def buildIndex(self):
+    with self._index_lock:
+      index = []
+      try:
+        for folder in self._scandir_sorted(self.mediapath)[0]:
+          folderpath = self.mediapath + folder + "/"
+          index.append((folder, [folderpath + file for file in self._scandir_sorted(folderpath)[1]]))
+      except OSError:
+        log.exception("Couldn't read media folder %s, keeping previous index", self.mediapath)
+        return
+      self.index = index
 
-  def isNew(self):
-    return self.new
+  #_scandir_sorted(String)
+  #Returns sorted names of subfolders and files in path, re-read only if the directory mtime changed
+  def _scandir_sorted(self, path):
+    mtime = os.stat(path).st_mtime_ns
+    cached = self._dir_cache.get(path)
+    if (cached and cached[0] == mtime):
+      return cached[1]
+    folders = []
+    files = []
+    with os.scandir(path) as entries:
+      for entry in entries:
+        (folders if entry.is_dir() else files).append(entry.name)
+    folders.sort()
+    files.sort()
+    self._dir_cache[path] = (mtime, (folders, files))
+    return folders, files
 
 #####################
 # CHANNELLIST-CLASS #
 #####################
+#Masks for Channellist.anyNew(), one byte per channel offset
+FILE_MASK = 0xFFFF
+
 class Channellist:
-  def __init__ (self, address):
-    self.channel = [Channel(i+address) for i in range(3)]
+  __slots__ = ("base", "count", "current", "changed")
 
-  #update(packet)
-  #Updates values of all channels with packet
-  def update(self, packet):
-    for i in range(3):
-      self.channel[i].update(packet)
+  def __init__ (self, address, count=3):
+    self.base = address - 1
+    self.count = count
+    self.current = None
+    self.changed = (1 << 8*count) - 1
+
+  #update(Tuple)
+  #Updates values of all channels with one slice of DMX-Data, changed holds the XOR to the last slice
+  def update(self, dmxData):
+    current = bytes(dmxData[self.base:self.base+self.count])
+    if (self.current is None):
+      self.changed = (1 << 8*self.count) - 1
+    elif (current == self.current):
+      self.changed = 0
+    else:
+      self.changed = int.from_bytes(current, "little") ^ int.from_bytes(self.current, "little")
+    self.current = current
 
   #isNew(Int)
   #Returns True, if channel at address+offset received a new value in last DMX-Frame
   def isNew(self, offset):
-    return self.channel[offset].isNew()
+    return (self.changed >> 8*offset) & 0xFF != 0
+
+  #anyNew(Int)
+  #Returns True, if any channel covered by mask received a new value in last DMX-Frame
+  def anyNew(self, mask):
+    return self.changed & mask != 0
 
   #get(Int)
   #Returns value of DMX-Channel at address+offset
   def get(self, offset):
-    return self.channel[offset].current
+    return self.current[offset]
 
 #############
 # DMX-CLASS #
@@ -137,46 +284,57 @@ class DMX:
 # VLC-CLASS #
 #############
 class VLC:
+  __slots__ = ("vlc_instance", "player", "loop", "playpath", "media", "_loop_media")
+
   def __init__(self):
-    self.vlc_instance = vlc.Instance()
+    self.vlc_instance = _VLC_INSTANCE
     self.player = self.vlc_instance.media_player_new()
     self.loop = False
     self.playpath = ""
+    self.media = None
+    self._loop_media = None
 
   #setMedia(String)
   #Sets media to play from a path String
   def setMedia(self, playpath):
+    if (playpath == self.playpath and self.media is not None):
+      return
     try:
       if (playpath != ""):
         self.media = self.vlc_instance.media_new(playpath)
         self.player.set_media(self.media)
         self.playpath = playpath
     except Exception as e:
-            print(traceback.format_exc())
+      log.exception("Couldn't set media %s", playpath)
 
   #setLoop(Boolean)
   #Sets state of loop at media
   def setLoop(self, loop):
     if (self.playpath != ""):
-      self.media.add_option("input-repeat=" + str(10000 if loop else 0))
+      if (loop == self.loop and self.media is self._loop_media):
+        return
+      self.media.add_option("input-repeat=" + ("10000" if loop else "0"))
+      self.loop = loop
+      self._loop_media = self.media
   
   #play()
   #Starts playing media from configured path
   def play(self):
     if (self.playpath != ""):
-      print("Starting Media '" + self.playpath + "' with Loop", "on" if self.loop else "off")
+      log.debug("Starting Media '%s' with Loop %s", self.playpath, "on" if self.loop else "off")
       self.player.play()
 
   #stop()
   #Stops media
   def stop(self):
-    print("Stopping Media")
+    log.debug("Stopping Media")
     self.player.stop()
 
 ###############
 # MAIN-METHOD #
 ###############
 def main():
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
   mediaserver = Server()
   mediaserver.start()
 
@@ -1,6 +1,13 @@
 from vlc import Instance
 import RPi.GPIO as GPIO
 import configparser
+import logging
+import subprocess
+import socket
+import threading
+import pyudev
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 import vlc
 import sacn
 import time
@@ -15,6 +22,48 @@ import os
 ##############################################################
 
 
+#Unterdrückt gleiche Warnungen und Fehler, die innerhalb von interval Sekunden wiederholt werden
+class RateLimitFilter(logging.Filter):
+  def __init__(self, interval=1.0):
+    super().__init__()
+    self.interval = interval
+    self.last = {}
+    self.lock = threading.Lock()
+
+  def filter(self, record):
+    if (record.levelno < logging.WARNING):
+      return True
+    message = record.getMessage()
+    with self.lock:
+      now = time.monotonic()
+      self.last = {m: t for m, t in self.last.items() if now - t < self.interval}
+      if (message in self.last):
+        return False
+      self.last[message] = now
+      return True
+
+log = logging.getLogger("mediaserver")
+log.addFilter(RateLimitFilter())
+
+#Prüft ohne vollständiges Auflisten, ob ein Verzeichnis leer ist
+def _is_empty(path):
+  with os.scandir(path) as it:
+    return next(it, None) is None
+
+#Liefert das Gerät (z.B. /dev/sda1), das an path eingehängt ist, oder None
+def _mount_device(path):
+  mountpoint = path.rstrip("/").replace(" ", "\\040")
+  with open("/proc/mounts") as mounts:
+    for line in mounts:
+      fields = line.split()
+      if (fields[1] == mountpoint):
+        return fields[0]
+  return None
+
+#VLC Instance, einmal pro Prozess
+_VLC_INSTANCE = vlc.Instance("--no-video-title-show", "--quiet", "--file-caching=50", "--network-caching=50")
+
+
 class Server:
   #Konstruktor
   def __init__ (self):
@@ -28,74 +77,236 @@ class Server:
     self.CH4Current = 0                                 
     self.CH4Last = 0                                  
     self.address = 1                                    #DMX Start Adress
+    self.universe = 1                                   #DMX Universe
     self.usb = None                                     #Name of USB Stick
+    self._base = None                                   #Mediapath on USB Stick
+    self._device = None                                 #Device node of USB Stick
+    self.udev = pyudev.Context()                        #udev for USB-Stick events
     self.findStick()                                    #Method to search for Stick
+    self._usb_present = True                            #Updated by udev observer
+    self._media_cache = {}                              #(Folder, File) -> VLC Media
+    self._media_loop = {}                               #VLC Media -> last set Loop state
     self.receiver = sacn.sACNreceiver()                 #sACN Receiver
-    self.data = 0;
 
     config = configparser.ConfigParser()
-    if len(os.listdir("/media/pi/")) == 0:
+    if _is_empty("/media/pi/"):
         self.findStick()
     config.read("/media/pi/" + self.usb + "/config.txt")
-    self.address = config.get("DMX-Konfiguration", "Adresse")
-    print("Loaded adress", self.address, " from configfile")
+    self.address = config.getint("DMX-Konfiguration", "Adresse")
+    self.universe = config.getint("DMX-Konfiguration", "Universum", fallback=1)
+    self.rcvbuf = config.getint("DMX-Konfiguration", "Empfangspuffer", fallback=4*1024*1024)
+    log.info("Loaded adress %d.%d from configfile", self.universe, self.address)
 
-    self.vlc_instance = vlc.Instance()                  #VLC Instance
+    self.vlc_instance = _VLC_INSTANCE                   #VLC Instance
     self.player = self.vlc_instance.media_player_new()
+    self.buildMediaCache()                              #VLC Media of all files on Stick
+    self.media_observer = None                          #Filesystem Observer on Stick
+    self.watchMedia()                                   #Rebuilds Media Cache on file changes
+
+    #DMX-Verarbeitung im eigenen Thread, dazwischen eintreffende Pakete werden zusammengefasst
+    self._work_ev = threading.Event()
+    self._latest = None
+    self.worker = threading.Thread(target=self._worker, name="DMX worker", daemon=True)
+    self.worker.start()
+    self.watchStick()                                   #Observer for USB-Stick events, needs Media Cache and Worker
 
-    #Define DMX Packet Callback
-    @self.receiver.listen_on('universe', universe=1)    # listens on universe 1
+    #Define DMX Packet Callback, übergibt das Paket nur an den Worker
+    @self.receiver.listen_on('universe', universe=self.universe)    # listens on configured universe
     def callback(packet):  # packet type: sacn.DataPacket
-      self.data = packet.dmxData
-
-      #Auswahl von Videoaktion
-      self.CH1Current = self.data[self.address-1]
-      self.CH2Current = self.data[self.address]
-      if ((self.CH1Current != self.CH1Last) or (self.CH2Current != self.CH2Last)): #Bei Änderung von DMX Werten
-        #Abfrage auf Stick
-        if len(os.listdir("/media/pi/")) == 0:
-          self.findStick()
+      self._latest = packet.dmxData
+      self._work_ev.set()
+
+    self.receiver.start()  # start the receiving thread
+    self.setReceiveBuffer(self.rcvbuf)
+    self.setRealtimePriority(20)
+    self.receiver.join_multicast(self.universe)
+
+  #Worker-Schleife, verarbeitet immer nur das neueste DMX-Paket
+  def _worker(self):
+    while True:
+      self._work_ev.wait()
+      self._work_ev.clear()
+      self.handleFrame(self._latest)
+
+  #Verarbeitet ein DMX-Paket: Video und Relais
+  def handleFrame(self, dmxData):
+    #Kanäle CH1-CH4 einmal als bytes ausschneiden
+    a = self.address
+    data = bytes(dmxData[a-1:a+3])
+
+    #Auswahl von Videoaktion
+    self.CH1Current = data[0]
+    self.CH2Current = data[1]
+    if ((self.CH1Current != self.CH1Last) or (self.CH2Current != self.CH2Last)): #Bei Änderung von DMX Werten
+      if not self._usb_present:
+        #Auswahl nicht übernehmen, damit sie nach dem Einstecken abgespielt wird
+        log.warning("Error no USB Device Found")
+      else:
         if (self.CH1Current > 0):
-          playpath = "/media/pi/" + self.usb + "/" + str(self.CH2Current).zfill(3) + "/" + str(self.CH1Current).zfill(3) + ".mp4"
-          print("Playing new Media: " + playpath)
-          self.media = self.vlc_instance.media_new(playpath)
-          self.player.set_media(self.media)
-          print("Turning Loop " + ("On" if (self.data[self.address+1] > 127) else "Off"))
-          self.media.add_option("input-repeat=" + str(10000 if (self.data[self.address+1] > 127) else 0))
-          self.player.play()
+          media = self._media_cache.get((self.CH2Current, self.CH1Current))
+          if media is None:
+            log.warning("No Media %03d/%03d.mp4 on USB Device", self.CH2Current, self.CH1Current)
+            self.player.stop()
+          else:
+            log.debug("Playing new Media: %s", media.get_mrl())
+            self.media = media
+            self.player.set_media(self.media)
+            loop = data[2] > 127
+            if (self._media_loop.get(media) != loop): #Option nur bei Änderung anhängen, sie bleibt am Media-Objekt
+              log.debug("Turning Loop %s", "On" if loop else "Off")
+              self.media.add_option("input-repeat=" + str(10000 if loop else 0))
+              self._media_loop[media] = loop
+            self.player.play()
         else:
-          print("Stopping Player")
+          log.debug("Stopping Player")
           self.player.stop()
-      self.CH1Last = self.CH1Current
-      self.CH2Last = self.CH2Current
-
-      self.CH4Current = self.data[self.address+2]
-      if (self.CH4Current != self.CH4Last): #Bei Änderung von DMX Werten
-        if (self.CH4Current > 127):
-          print("Turning Relais on")
-          GPIO.output(23, GPIO.HIGH)
-          GPIO.output(24, GPIO.HIGH)
-        else:
-          print("Turning Relais off")
-          GPIO.output(23, GPIO.LOW)
-          GPIO.output(24, GPIO.LOW)
-      self.CH4Last = self.CH4Current
+        self.CH1Last = self.CH1Current
+        self.CH2Last = self.CH2Current
 
-    self.receiver.start()  # start the receiving thread
-    self.receiver.join_multicast(1)
+    self.CH4Current = data[3]
+    if (self.CH4Current != self.CH4Last): #Bei Änderung von DMX Werten
+      if (self.CH4Current > 127):
+        log.debug("Turning Relais on")
+        GPIO.output(23, GPIO.HIGH)
+        GPIO.output(24, GPIO.HIGH)
+      else:
+        log.debug("Turning Relais off")
+        GPIO.output(23, GPIO.LOW)
+        GPIO.output(24, GPIO.LOW)
+    self.CH4Last = self.CH4Current
+
+  #Setzt den sACN-Empfangsthread auf SCHED_FIFO gegen Jitter durch den Scheduler
+  def setRealtimePriority(self, priority):
+    try:
+      thread = self.receiver._thread if hasattr(self.receiver, "sock") else self.receiver._handler.socket._thread
+      os.sched_setscheduler(thread.native_id, os.SCHED_FIFO, os.sched_param(priority))
+      log.info("Set receiver thread to SCHED_FIFO priority %d", priority)
+    except Exception as e:
+      log.warning("Couldn't set realtime priority: %s", e)
+
+  #Vergrößert den Empfangspuffer des sACN-Sockets gegen Paketverlust
+  def setReceiveBuffer(self, size):
+    try:
+      if hasattr(self.receiver, "sock"):
+        sock = self.receiver.sock
+      else:
+        sock = self.receiver._handler.socket._socket
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+      log.info("Set receive buffer to %d bytes", sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+    except Exception as e:
+      log.warning("Couldn't set receive buffer: %s", e)
     
    
-  #USB-Stick Such-Schleife
+  #USB-Stick Such-Schleife, wartet auf udev-Ereignisse, spätestens alle 2 s wird erneut geprüft
   def findStick(self):
-    while len(os.listdir("/media/pi/")) == 0:
-      time.sleep(2)
-      print('[{3}:{4}:{5}]\tError no USB Device Found'.format(*time.localtime(time.time())))
+    monitor = pyudev.Monitor.from_netlink(self.udev)
+    monitor.filter_by('block')
+    monitor.start()
+    while _is_empty("/media/pi/"):
+      log.warning("Error no USB Device Found")
+      device = monitor.poll(timeout=2)
+      if (device is not None and device.action == 'add' and device.get('ID_FS_USAGE') == 'filesystem'):
+        self.waitForMount()
 
     self.usb = os.listdir("/media/pi/")[0]
+    self._base = "/media/pi/" + self.usb + "/"
+    self._device = _mount_device(self._base)
+
+  #Wartet nach dem Einstecken bis zu 10 s auf den Automount
+  def waitForMount(self):
+    for i in range(20):
+      if not _is_empty("/media/pi/"):
+        return True
+      time.sleep(0.5)
+    return False
+
+  #Beobachtet USB-Sticks im Hintergrund, damit der DMX-Callback kein Dateisystem abfragt
+  def watchStick(self):
+    monitor = pyudev.Monitor.from_netlink(self.udev)
+    monitor.filter_by('block')
+    self.observer = pyudev.MonitorObserver(monitor, callback=self.stickEvent, name="USB observer")
+    self.observer.daemon = True
+    self.observer.start()
+
+  #USB-Stick Ereignis, hält self.usb und self._usb_present aktuell
+  def stickEvent(self, device):
+    if (device.get('ID_FS_USAGE') != 'filesystem'):
+      return
+    if (device.action == 'remove'):
+      #Andere Geräte ignorieren, solange der Stick noch eingehängt ist
+      if (device.device_node != self._device and os.path.ismount(self._base.rstrip("/"))):
+        return
+      log.warning("USB Device removed")
+      self.stopWatchMedia()
+      self._usb_present = False
+      self._media_cache = {}
+      self._media_loop = {}
+      #Auswahl nach dem Einstecken erneut abspielen
+      self.CH1Last = -1
+      self.CH2Last = -1
+    elif (device.action == 'add'):
+      #Ohne Zeitlimit auf den Automount warten, solange der Stick noch steckt
+      while not self.waitForMount():
+        if not os.path.exists(device.device_node):
+          return
+      self.usb = os.listdir("/media/pi/")[0]
+      self._base = "/media/pi/" + self.usb + "/"
+      self._device = _mount_device(self._base)
+      self.buildMediaCache()
+      self.watchMedia()
+      self._usb_present = True
+      log.info("USB Device %s found", self.usb)
+      #Aktuelle Auswahl abspielen
+      if (self._latest is not None):
+        self._work_ev.set()
+
+  #Beobachtet die Dateien auf dem Stick und baut den Media-Cache neu auf, wenn Dateien hinzukommen, gelöscht oder verschoben werden
+  def watchMedia(self):
+    self.stopWatchMedia()
+    server = self
+    class Handler(FileSystemEventHandler):
+      def on_created(self, event):
+        server.buildMediaCache()
+      def on_deleted(self, event):
+        server.buildMediaCache()
+      def on_moved(self, event):
+        server.buildMediaCache()
+    self.media_observer = Observer()
+    self.media_observer.daemon = True
+    self.media_observer.schedule(Handler(), self._base, recursive=True)
+    self.media_observer.start()
+
+  #Beendet den Observer des vorherigen Sticks
+  def stopWatchMedia(self):
+    if (self.media_observer is not None):
+      self.media_observer.stop()
+      self.media_observer = None
+
+  #Legt für alle Dateien NNN/NNN.mp4 auf dem Stick vorab VLC-Media-Objekte an, bei Lesefehlern bleibt der alte Cache
+  def buildMediaCache(self):
+    cache = {}
+    try:
+      with os.scandir(self._base) as folders:
+        for folder in folders:
+          if (folder.is_dir() and len(folder.name) == 3 and folder.name.isdecimal()):
+            with os.scandir(folder.path) as files:
+              for file in files:
+                if (len(file.name) == 7 and file.name.lower().endswith(".mp4") and file.name[:3].isdecimal()):
+                  cache[(int(folder.name), int(file.name[:3]))] = self.vlc_instance.media_new(file.path)
+    except OSError as e:
+      log.warning("Couldn't read USB Device, keeping previous media: %s", e)
+      return
+    self._media_loop = {}
+    self._media_cache = cache
+    log.info("Loaded %d media files from USB Device", len(cache))
      
 #Programmaufruf
 def main():
-  os.system("tvservice -p")
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+  try:
+    subprocess.run(["tvservice", "-p"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+  except OSError as e:
+    log.warning("Couldn't run tvservice: %s", e)
   server = Server()
   
 